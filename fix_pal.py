@@ -13,25 +13,39 @@ __version__ = "2.0"
 
 
 import argparse
+import errno
+import json
+import os
 import re
+import stat
 import subprocess
 import sys
 import tempfile
 
 from fractions import Fraction
-from os.path import realpath
-from pathlib import Path
-from shutil import which
 
 
 # Modify this if the correction factor needs tweaking. It's treated as a constant
 # throughout.
 CORRECTION_FACTOR = "25/24"
 
+_FACTOR = Fraction(CORRECTION_FACTOR)
+
+# Codec `ffmpeg` uses for the re-sampled audio. FLAC is lossless, so the only change
+# to the audio is the speed correction itself. Swap in another `ffmpeg` audio encoder
+# name if you'd rather trade that for size.
+AUDIO_CODEC = "flac"
+
+# Matches a single `HH:MM:SS.nnnnnnnnn` timecode in a chapter or track file.
+_TC_RE = re.compile(r"\d{2}:\d{2}:\d{2}\.\d+")
+
+# errno values that mean a path doesn't exist, as far as `Path.exists` is concerned.
+_MISSING_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP)
+
 
 # dict of tools that this script calls. The `None` values are replaced at runtime with
 # each tool's absolute path if the tool is installed and executable.
-tools = {"ffmpeg": None, "mkvextract": None, "mkvinfo": None, "mkvmerge": None}
+tools = {"ffmpeg": None, "mkvextract": None, "mkvmerge": None}
 
 
 def check_prereqs():
@@ -42,16 +56,39 @@ def check_prereqs():
     installed.
     """
     global tools
-    missing_tools = []
-    for tool in tools:
-        if not (path := which(tool)):
-            missing_tools.append(tool)
-        else:
-            tools[tool] = path
+    # Walk PATH once for all the tools, rather than once per tool. Like `which`, on
+    # Windows only names ending in a PATHEXT extension count (e.g. `FFmpeg.EXE`), and
+    # names are compared case-insensitively.
+    pathext = os.environ.get("PATHEXT", ".EXE").split(os.pathsep)
+    exe_exts = {os.path.normcase(ext) for ext in pathext if ext}
+
+    missing_tools = set(tools)
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        try:
+            with os.scandir(directory or os.curdir) as entries:
+                for entry in entries:
+                    name = os.path.normcase(entry.name)
+                    if os.name == "nt":
+                        tool, ext = os.path.splitext(name)
+                        if ext not in exe_exts:
+                            continue
+                    else:
+                        tool = name
+                    if (
+                        tool in missing_tools
+                        and entry.is_file()
+                        and os.access(entry.path, os.X_OK)
+                    ):
+                        tools[tool] = entry.path
+                        missing_tools.discard(tool)
+        except OSError:
+            continue
+        if not missing_tools:
+            break
 
     if len(missing_tools) > 0:
         msg = "Error: the following utilities are missing from your system:"
-        for tool in missing_tools:
+        for tool in sorted(missing_tools):
             msg += f"\n\t{tool}"
         msg += "\nPlease install them in order to use this script."
         sys.exit(msg)
@@ -70,6 +107,15 @@ def handle_args():
         metavar="output_file",
         help="The filename for the new, processed file.",
     )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        "-f",
+        "--force",
+        dest="yes",
+        action="store_true",
+        help="Overwrite the output file if it exists, without asking.",
+    )
     return parser.parse_args()
 
 
@@ -79,32 +125,42 @@ def check_exists(path):
 
     If it doesn't or isn't, complain and quit.
     """
-    path = Path(path)  # lol
-    if not Path.exists(path):
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno not in _MISSING_ERRNOS:
+            raise
         sys.exit("Error: input path does not exist.")
-    if not Path.is_file(path):
+    if not stat.S_ISREG(st.st_mode):
         sys.exit("Error: input path is not a regular file.")
 
 
-def confirm_overwrite(path):
+def confirm_overwrite(path, yes=False):
     """
     Prompt the user to confirm overwriting a file at a given path.
 
-    If the user does not confirm, or if the path points to a directory, quit.
+    If the user does not confirm, or if the path points to a directory, quit. If `yes`
+    is set, overwrite without asking.
     """
-    path = Path(path)  # oops I did it again
-    if Path.exists(path):
-        if Path.is_dir(path):
-            sys.exit("Error: output path is a directory!")
-
-        query = (
-            f"Output file `{path}` already exists.\n"
-            + "Do you want to overwrite it? [y|N] "
-        )
-        proceed = input(query)
-        if proceed.casefold() != "y".casefold():
-            print("Stopping.")
-            sys.exit()
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno not in _MISSING_ERRNOS:
+            raise
+        return
+    if stat.S_ISDIR(st.st_mode):
+        sys.exit("Error: output path is a directory!")
+    if yes:
+        return
+
+    query = (
+        f"Output file `{path}` already exists.\n"
+        + "Do you want to overwrite it? [y|N] "
+    )
+    proceed = input(query)
+    if proceed.casefold() != "y".casefold():
+        print("Stopping.")
+        sys.exit()
 
 
 def get_and_validate_args():
@@ -112,11 +168,18 @@ def get_and_validate_args():
     args = handle_args()
     check_exists(args.infile)
 
-    if realpath(args.infile) == realpath(args.outfile):
+    try:
+        same_file = os.path.samefile(args.infile, args.outfile)
+    except OSError as e:
+        if e.errno not in _MISSING_ERRNOS:
+            raise
+        # The output file doesn't exist (yet), so it can't be the input.
+        same_file = False
+    if same_file:
         # Don't allow directly overwriting the input file.
         sys.exit("Error: input and output paths are identical.")
 
-    confirm_overwrite(args.outfile)
+    confirm_overwrite(args.outfile, args.yes)
     return args.infile, args.outfile
 
 
@@ -127,105 +190,129 @@ def adjust_timestamp(matchobj):
     This function modified from code by James Ainslie from
     <https://blog.delx.net.au/2016/05/fixing-pal-speedup-and-how-film-and-video-work/comment-page-1/#comment-100160>
     """
-    old_timestamp = matchobj.group(0)
-    hrs = int(old_timestamp[:2])
-    mins = int(old_timestamp[3:5])
-    secs = float(old_timestamp[6:])
-    old_total_secs = (3600 * hrs) + (60 * mins) + secs
-    new_total_secs = Fraction(CORRECTION_FACTOR) * old_total_secs
-    new_timestamp = "{:02.0f}:{:02.0f}:{:02.9f}".format(
-        new_total_secs // 3600, new_total_secs % 3600 // 60, new_total_secs % 60
-    )
+    hrs, mins, secs = matchobj.group(0).split(":")
+    whole_secs, frac = secs.split(".")
+    old_ns = (3600 * int(hrs) + 60 * int(mins) + int(whole_secs)) * 10**9
+    old_ns += int(frac.ljust(9, "0")[:9])
+    # Round to the nearest nanosecond, as the old float formatting did.
+    num, den = _FACTOR.numerator, _FACTOR.denominator
+    new_ns = (old_ns * num + den // 2) // den
+
+    hrs, rem = divmod(new_ns, 3600 * 10**9)
+    mins, rem = divmod(rem, 60 * 10**9)
+    secs, ns = divmod(rem, 10**9)
+    new_timestamp = f"{hrs:02d}:{mins:02d}:{secs:02d}.{ns:09d}"
     return new_timestamp
 
 
-def edit_timecodes(infile, outfile):
+def edit_timecodes(text):
     """
-    Read an arbitrary track file, and produce a new one with timecodes adjusted.
+    Take the contents of an arbitrary track file, and return them with timecodes
+    adjusted.
 
     This function inspired by code by James Ainslie from
     <https://blog.delx.net.au/2016/05/fixing-pal-speedup-and-how-film-and-video-work/comment-page-1/#comment-100160>
     """
-    pattern = r"\d{2}:\d{2}:\d{2}.\d+"
-    with open(infile, "r") as inf, open(outfile, "w") as outf:
-        for line in inf:
-            fixed_line = re.sub(pattern, adjust_timestamp, line)
-            outf.write(fixed_line)
+    return _TC_RE.sub(adjust_timestamp, text)
+
+
+def probe_mkvmerge(infile):
+    """
+    Run `mkvmerge -J` on a file once and return the parsed identification.
+
+    If `mkvmerge` doesn't produce any JSON at all, return an empty dict; `main` treats
+    that like an unrecognized file.
+    """
+    cmd = [tools["mkvmerge"], "-J", infile]
+    try:
+        return json.loads(subprocess.run(cmd, capture_output=True).stdout)
+    except json.JSONDecodeError:
+        return {}
 
 
-def fix_chapters(infile, tmpdir):
+def fix_chapters(infile, tmpdir, probe):
     """
     Given an MKV file, pull out the existing chapters, then re-time them.
 
+    `probe` is the output of `probe_mkvmerge` for the same file.
+
     This function modified from code by James Ainslie from
     <https://blog.delx.net.au/2016/05/fixing-pal-speedup-and-how-film-and-video-work/comment-page-1/#comment-100160>
     """
-    cmd = [tools["mkvmerge"], "-i", infile]
-    stdout = subprocess.run(cmd, text=True, capture_output=True).stdout
-    if "Chapters".casefold() not in stdout.casefold():
+    if not probe.get("chapters"):
         return ""
 
     old_chapter_file = tmpdir + "/hello-old-chap.xml"  # couldn't help it
     new_chapter_file = tmpdir + "/hello-new-chap.xml"
-    subprocess.run([tools["mkvextract"], infile, "chapters", old_chapter_file])
-    edit_timecodes(old_chapter_file, new_chapter_file)
+    cmd = [tools["mkvextract"], infile, "chapters", old_chapter_file]
+    # `mkvextract` exits with 1 for warnings and 2 for errors.
+    if subprocess.run(cmd).returncode > 1:
+        sys.exit("Error: `mkvextract` couldn't extract the chapters.")
+
+    with open(old_chapter_file, "r", encoding="utf-8") as inf:
+        old_chapters = inf.read()
+    if not old_chapters.strip():
+        sys.exit("Error: `mkvextract` extracted no chapters.")
+    with open(new_chapter_file, "w", encoding="utf-8") as outf:
+        outf.write(edit_timecodes(old_chapters))
     return ["--chapters", new_chapter_file]
 
 
-def get_sync_flags(infile):
+def get_sync_flags(probe):
     """
     Get info on NON-AUDIO tracks and build an array of `--sync` args for later use.
+
+    `probe` is the output of `probe_mkvmerge`.
     """
     sync_args = []
-    cmd = [tools["mkvmerge"], "-i", infile]
-    stdout = subprocess.run(cmd, text=True, capture_output=True).stdout
-    pattern = r"()\d+(?=:)"
-    for line in stdout.splitlines():
-        if "Track ID".casefold() in line.casefold():
-            if "audio".casefold() not in line.casefold():
-                track_id = re.search(pattern, line).group(0)
-                sync_args.extend(["--sync", f"{track_id}:0,{CORRECTION_FACTOR}"])
+    for track in probe["tracks"]:
+        if track["type"] != "audio":
+            sync_args.extend(["--sync", f"{track['id']}:0,{CORRECTION_FACTOR}"])
     return sync_args
 
 
 # TODO: construct args that handle audio tracks individually, as in `get_sync_flags` above.
-def get_audio_sample_rate(file):
+def get_audio_sample_rate(probe):
     """
-    Determine the sample rate for audio.
+    Determine the sample rate for audio from `probe_mkvmerge` output.
 
-    If different tracks have different rates, choose that of the first audio track
-    (technically, the first CHANNEL of the first audio track).
+    If different tracks have different rates, choose that of the first audio track.
     """
-    cmd = [tools["mkvinfo"], file]
-    stdout = subprocess.run(cmd, text=True, capture_output=True).stdout
-    pattern = r"\d+\.?\d*"
-    for line in stdout.splitlines():
-        if "Sampling frequency".casefold() in line.casefold():
-            return re.search(pattern, line).group(0)
+    return next(
+        (
+            track["properties"]["audio_sampling_frequency"]
+            for track in probe["tracks"]
+            if track["type"] == "audio"
+        ),
+        None,
+    )
 
 
-def fix_audio(infile, outfile):
+def fix_audio(infile, outfile, sample_rate):
     """
     Slow down the audio and re-sample at the original sample rate.
 
     Copy video, subtitles, chapters exactly as they are in the input file.
     """
-    audio_factor = 1 / Fraction(CORRECTION_FACTOR)
-    sample_rate = get_audio_sample_rate(infile)
+    audio_factor = 1 / _FACTOR
 
     cmd = [
         tools["ffmpeg"],
         "-y",
+        "-fflags",
+        "+genpts",
         "-i",
         infile,
-        "-map",
-        "0",
         "-filter:a",
         f"asetrate={sample_rate}*{audio_factor}",
+        "-c:a",
+        AUDIO_CODEC,
         "-c:v",
         "copy",
         "-c:s",
         "copy",
+        "-map",
+        "0",
         "-max_interleave_delta",
         "0",
         outfile,
@@ -241,9 +328,20 @@ def main():
         tmpfile = tmpdir + "/temp.mkv"
 
         # Get some info from the source file and build some of our args for the
-        # `mkvmerge` call
-        chapter_args = fix_chapters(infile, tmpdir)
-        sync_args = get_sync_flags(infile)
+        # `mkvmerge` call.
+        probe = probe_mkvmerge(infile)
+        if probe.get("errors") or not probe.get("container", {}).get("recognized"):
+            msg = "Error: `mkvmerge` couldn't read the input file."
+            for error in probe.get("errors", []):
+                msg += f"\n\t{error}"
+            sys.exit(msg)
+
+        # The `mkvmerge` step leaves the audio untouched, so the sample rate is read
+        # from the source rather than from the temp file afterwards.
+        sample_rate = get_audio_sample_rate(probe)
+
+        chapter_args = fix_chapters(infile, tmpdir, probe)
+        sync_args = get_sync_flags(probe)
 
         # For each video track, adjust the framerate by the correction factor. (No
         # re-encoding necessary!) Adjust subtitle timings to match. Add the adjusted
@@ -257,8 +355,9 @@ def main():
         subprocess.run(cmd)
 
         # This is why we used a temp file... we still have to re-encode audio in order
-        # to keep the sample rate the same.
-        fix_audio(tmpfile, outfile)
+        # to keep the sample rate the same. (`mkvmerge` can't stream its output to
+        # `ffmpeg` instead: it needs a seekable output to write cues and seek head.)
+        fix_audio(tmpfile, outfile, sample_rate)
 
 
 if __name__ == "__main__":